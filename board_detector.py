@@ -2,11 +2,59 @@
 Chess board detector using OpenCV
 """
 import os
+import logging
 import numpy as np
 import cv2
 import chess
 from kivy.utils import platform
 
+logger = logging.getLogger(__name__)
+
+# Piece classifier model, an int8-quantized CNN mapping a 32x32 square
+# image to one of 13 classes (empty + 12 pieces)
+PIECE_MODEL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'piece_classifier.tflite')
+PIECE_INPUT_SIZE = 32
+PIECE_MODEL_THREADS = 4
+
+# Piece code for each classifier output class (0 = empty)
+PIECE_CLASS_CODES = np.array([0] + [ord(c) for c in 'PNBRQKpnbrqk'], dtype=np.uint8)
+
+# chess.Piece for each non-empty piece code
+PIECES_BY_CODE = {code: chess.Piece.from_symbol(chr(code)) for code in PIECE_CLASS_CODES[1:].tolist()}
+
+# Brightness thresholds used by the placeholder square classifier
+EMPTY_MIN_BRIGHTNESS = 90
+WHITE_MIN_BRIGHTNESS = 170
+
+def _classify_squares(gray, square_size):
+    """
+    Classify the 64 squares of a grayscale board by average brightness
+    
+    Args:
+        gray: Grayscale image of the board
+        square_size: Side length of a single square in pixels
+        
+    Returns:
+        8x8 uint8 array of piece codes (0 = empty), in image row order
+    """
+    # Sum the pixels of every square in one integer reduction and compare
+    # against thresholds scaled by the square area, which is equivalent to
+    # thresholding the mean without any floating point work
+    size = 8 * square_size
+    squares = gray[:size, :size].reshape(8, square_size, 8, square_size)
+    totals = squares.sum(axis=(1, 3), dtype=np.uint32)
+    area = square_size * square_size
+    
+    # Mid-range brightness - assume empty square
+    empty = (totals > EMPTY_MIN_BRIGHTNESS * area) & (totals < WHITE_MIN_BRIGHTNESS * area)
+    
+    # Very bright - assume white piece, darker - assume black
+    # Simplified: always a pawn
+    white = totals >= WHITE_MIN_BRIGHTNESS * area
+    
+    pieces = np.where(white, ord('P'), ord('p'))
+    return np.where(empty, 0, pieces).astype(np.uint8)
+
 class ChessBoardDetector:
     """
     Detects chess boards in images and extracts position information
@@ -14,28 +62,56 @@ class ChessBoardDetector:
     
     def __init__(self):
         """Initialize board detector with piece detection models"""
-        # Initialize the piece detector
-        # This would normally use a pre-trained neural network model
-        # For simplicity, we'll use a basic approach with template matching
+        # Load the piece classifier, if one is bundled with the app.
+        # Without it we fall back to a simple brightness heuristic
+        self.piece_model = self._init_piece_model()
         
-        # Load piece templates - these would be actual templates in a real implementation
-        self.piece_templates = self._init_piece_templates()
+        # Only a classifier trained on color squares needs a color board;
+        # otherwise the board is rectified from the grayscale image
+        self.color_board = (self.piece_model is not None and
+                            self.piece_model.get_input_details()[0]['shape'][-1] == 3)
         
         # Board detection parameters
         self.min_board_size = 200  # Minimum expected board size in pixels
         self.square_threshold = 0.7  # Threshold for square detection
+        self.board_size = 400  # Side length of the rectified board in pixels
+        self.grid_edge_ratio = 3.0  # Grid line edge strength relative to the average column/row
+        
+        # Perspective remap tables keyed by quantized board corners, so a
+        # board that stays put between screenshots reuses the same maps
+        self._map_cache = {}
+        self.map_cache_size = 8  # Maximum number of cached board positions
+        self.corner_quantum = 4  # Corner rounding step in pixels
     
-    def _init_piece_templates(self):
-        """Initialize piece templates for recognition"""
-        # In a real implementation, we would load actual templates or models
-        # This is a simple placeholder
-        templates = {
-            'white_pawn': None, 'white_knight': None, 'white_bishop': None,
-            'white_rook': None, 'white_queen': None, 'white_king': None,
-            'black_pawn': None, 'black_knight': None, 'black_bishop': None,
-            'black_rook': None, 'black_queen': None, 'black_king': None
-        }
-        return templates
+    def _init_piece_model(self):
+        """Initialize the TFLite piece classifier, or None if unavailable"""
+        if not os.path.exists(PIECE_MODEL_PATH):
+            return None
+        
+        try:
+            try:
+                from tflite_runtime.interpreter import Interpreter
+            except ImportError:
+                from tensorflow.lite import Interpreter
+            
+            interpreter = Interpreter(model_path=PIECE_MODEL_PATH,
+                                      num_threads=PIECE_MODEL_THREADS)
+            
+            # Classify all 64 squares in a single batched inference call
+            input_details = interpreter.get_input_details()[0]
+            channels = input_details['shape'][-1]
+            interpreter.resize_tensor_input(
+                input_details['index'],
+                (64, PIECE_INPUT_SIZE, PIECE_INPUT_SIZE, channels)
+            )
+            interpreter.allocate_tensors()
+            
+            logger.info("Piece classifier loaded")
+            return interpreter
+        except Exception as e:
+            # The interpreter reports bad models with its own error types
+            logger.error("Error loading piece classifier: %s", e)
+            return None
     
     def detect_board(self, image):
         """
@@ -45,72 +121,151 @@ class ChessBoardDetector:
             image: OpenCV image (numpy array)
             
         Returns:
-            Cropped and perspective-corrected image of the chess board
+            Cropped and perspective-corrected image of the chess board,
+            grayscale unless the piece classifier needs color
         """
         # Convert to grayscale if it's a color image
         if len(image.shape) == 3:
             gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
         else:
-            gray = image.copy()
+            gray = image
+        
+        # Fast path: the image is already a tightly cropped board
+        if self._is_board_image(gray):
+            source = image if self.color_board else gray
+            return cv2.resize(source, (self.board_size, self.board_size),
+                              interpolation=cv2.INTER_AREA)
         
-        # Apply adaptive thresholding to get binary image
-        binary = cv2.adaptiveThreshold(
-            gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, 
-            cv2.THRESH_BINARY, 11, 2
-        )
+        # Blur, then find edges and thicken them so the board outline closes
+        blurred = cv2.GaussianBlur(gray, (5, 5), 0)
+        edges = cv2.Canny(blurred, 50, 150)
+        edges = cv2.dilate(edges, np.ones((5, 5), np.uint8))
         
-        # Find contours
-        contours, _ = cv2.findContours(binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        # Find contours, keeping only the largest few candidates
+        contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        contours = sorted(contours, key=cv2.contourArea, reverse=True)[:5]
+        
+        # The board must cover a reasonable part of the screenshot
+        img_area = gray.size
+        min_area = max(0.05 * img_area, self.min_board_size * self.min_board_size)
         
         # Filter contours by size and shape
         for contour in contours:
+            # Contours are sorted by area, so the rest are too small as well
+            if cv2.contourArea(contour) <= min_area:
+                break
+            
             # Approximate contour as a polygon
             perimeter = cv2.arcLength(contour, True)
             approx = cv2.approxPolyDP(contour, 0.02 * perimeter, True)
             
-            # Check if the contour is roughly square (4 corners) and of sufficient size
-            if len(approx) == 4 and cv2.contourArea(contour) > self.min_board_size * self.min_board_size:
+            # Check if the contour is roughly square (4 corners)
+            if len(approx) == 4:
                 # Perspective transform to get a top-down view
-                # Get corners in the right order
-                corners = sorted(approx.reshape(-1, 2), key=lambda p: p[0] + p[1])
-                top_left = corners[0]
-                bottom_right = corners[3]
-                
-                # Sort the remaining corners
-                remaining = [corners[1], corners[2]]
-                remaining.sort(key=lambda p: p[1] - p[0])
-                top_right = remaining[0]
-                bottom_left = remaining[1]
-                
-                src_pts = np.array([top_left, top_right, bottom_right, bottom_left], dtype=np.float32)
-                
-                # Calculate the target size (making it square)
-                width = max(
-                    np.linalg.norm(top_right - top_left),
-                    np.linalg.norm(bottom_right - bottom_left)
-                )
-                height = max(
-                    np.linalg.norm(bottom_left - top_left),
-                    np.linalg.norm(bottom_right - top_right)
-                )
-                square_size = max(int(width), int(height))
-                
-                dst_pts = np.array([
-                    [0, 0],
-                    [square_size - 1, 0],
-                    [square_size - 1, square_size - 1],
-                    [0, square_size - 1]
-                ], dtype=np.float32)
+                # Get corners in the right order: the top-left corner has the
+                # smallest x + y and the bottom-right the largest, while the
+                # top-right has the smallest y - x and the bottom-left the largest
+                pts = approx.reshape(4, 2).astype(np.float32)
+                sums = pts.sum(axis=1)
+                diffs = np.diff(pts, axis=1).ravel()
+                src_pts = pts[[sums.argmin(), diffs.argmin(), sums.argmax(), diffs.argmax()]]
                 
                 # Apply perspective transform
-                M = cv2.getPerspectiveTransform(src_pts, dst_pts)
-                warped = cv2.warpPerspective(image, M, (square_size, square_size))
-                
-                return warped
+                source = image if self.color_board else gray
+                return self._warp_board(source, src_pts, self.board_size)
         
         # No valid board found
         return None
     
+    def _is_board_image(self, gray):
+        """
+        Check whether an image is a chess board filling the whole frame
+        
+        Args:
+            gray: Grayscale image
+            
+        Returns:
+            True if the image is nearly square and has strong vertical and
+            horizontal edges on the 8x8 grid lines
+        """
+        height, width = gray.shape[:2]
+        if abs(height - width) / max(height, width) >= 0.05:
+            return False
+        
+        grad_x = np.abs(cv2.Sobel(gray, cv2.CV_16S, 1, 0))
+        grad_y = np.abs(cv2.Sobel(gray, cv2.CV_16S, 0, 1))
+        
+        # Edge strength summed along each column and each row
+        return (self._has_grid_lines(grad_x.sum(axis=0, dtype=np.int64)) and
+                self._has_grid_lines(grad_y.sum(axis=1, dtype=np.int64)))
+    
+    def _has_grid_lines(self, profile):
+        """
+        Check whether an edge profile peaks at the 7 inner grid lines
+        
+        Args:
+            profile: Edge strength per column (or row)
+            
+        Returns:
+            True if every inner grid line is much stronger than average
+        """
+        mean = profile.mean()
+        if mean <= 0:
+            return False
+        
+        # Allow the lines to be a few pixels off their ideal position
+        size = len(profile)
+        tolerance = max(1, size // 64)
+        for k in range(1, 8):
+            center = round(k * size / 8)
+            window = profile[max(0, center - tolerance):center + tolerance + 1]
+            if window.max() < self.grid_edge_ratio * mean:
+                return False
+        return True
+    
+    def _warp_board(self, image, src_pts, square_size):
+        """
+        Warp the board region to a square top-down view
+        
+        Args:
+            image: Source image
+            src_pts: Board corners (top-left, top-right, bottom-right, bottom-left)
+            square_size: Side length of the output image in pixels
+            
+        Returns:
+            Perspective-corrected image of the board
+        """
+        # Corners are rounded so small jitter between frames still hits the cache
+        q = self.corner_quantum
+        key = tuple(int(v) for v in np.round(src_pts / q).ravel()) + (square_size,)
+        
+        maps = self._map_cache.get(key)
+        if maps is None:
+            dst_pts = np.array([
+                [0, 0],
+                [square_size - 1, 0],
+                [square_size - 1, square_size - 1],
+                [0, square_size - 1]
+            ], dtype=np.float32)
+            M = cv2.getPerspectiveTransform(src_pts, dst_pts).astype(np.float32)
+            
+            # With identity camera matrices and no distortion, using the
+            # homography as the rectification transform yields the same
+            # mapping as warpPerspective, as fixed-point maps for a fast remap
+            identity = np.eye(3, dtype=np.float32)
+            maps = cv2.initUndistortRectifyMap(
+                identity, None, M, identity,
+                (square_size, square_size), cv2.CV_16SC2
+            )
+            
+            # Drop the oldest entry once the cache is full
+            if len(self._map_cache) >= self.map_cache_size:
+                del self._map_cache[next(iter(self._map_cache))]
+            self._map_cache[key] = maps
+        
+        map1, map2 = maps
+        return cv2.remap(image, map1, map2, cv2.INTER_LINEAR)
+    
     def get_position_fen(self, board_image):
         """
         Extract chess position from board image and return FEN string
@@ -136,99 +291,92 @@ class ChessBoardDetector:
             height, width = board_image.shape[:2]
             square_size = height // 8
             
-            # Initialize empty board representation
-            board = [[' ' for _ in range(8)] for _ in range(8)]
-            
-            # For each square on the board
-            for row in range(8):
-                for col in range(8):
-                    # Extract the square image
-                    y1 = row * square_size
-                    y2 = (row + 1) * square_size
-                    x1 = col * square_size
-                    x2 = (col + 1) * square_size
-                    
-                    square_img = board_image[y1:y2, x1:x2]
-                    
-                    # In a real implementation, here we would:
-                    # 1. Determine if the square is empty
-                    # 2. If not empty, classify the piece (type and color)
-                    
-                    # For demo, we'll use a placeholder function
-                    piece = self._detect_piece_on_square(square_img)
-                    if piece:
-                        board[7-row][col] = piece
-            
-            # Convert board array to FEN
-            fen = self._board_to_fen(board)
-            return fen
+            # Determine if each square is empty and, if not, classify
+            # the piece (type and color)
+            pieces = self._detect_pieces(board_image, square_size)[::-1]
             
-        except Exception as e:
-            print(f"Error in position extraction: {str(e)}")
+            # Place the detected pieces on an empty board
+            rows, cols = np.nonzero(pieces)
+            board = chess.Board.empty()
+            board.set_piece_map({
+                chess.square(col, 7 - row): PIECES_BY_CODE[code]
+                for row, col, code in zip(rows.tolist(), cols.tolist(), pieces[rows, cols].tolist())
+            })
+            
+            # For simplicity, assume it's white's turn and all castling rights
+            # available, keeping only those the piece placement allows
+            board.castling_rights = chess.BB_CORNERS
+            board.castling_rights = board.clean_castling_rights()
+            
+            return board.fen()
+            
+        except (cv2.error, ValueError, RuntimeError) as e:
+            logger.warning("Error in position extraction: %s", e)
             # Return starting position as fallback
             return "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
     
-    def _detect_piece_on_square(self, square_img):
+    def _detect_pieces(self, board_image, square_size):
         """
-        Detect chess piece in a square image
+        Detect chess pieces on all 64 squares of a board image
         
         Args:
-            square_img: Image of a single chess square
+            board_image: Image of the board
+            square_size: Side length of a single square in pixels
             
         Returns:
-            Piece code or None if empty
+            8x8 uint8 array of piece codes (ASCII value of the FEN symbol,
+            0 if empty), in image row order
         """
-        # Placeholder implementation - in a real app this would use ML
-        # For simplicity, we'll just check brightness and color
-        # to estimate if there's a piece and if it's white or black
+        if self.piece_model is not None:
+            return self._classify_pieces(board_image, square_size)
         
-        # Convert to grayscale and calculate average brightness
-        if len(square_img.shape) == 3:
-            gray = cv2.cvtColor(square_img, cv2.COLOR_BGR2GRAY)
+        # Placeholder implementation used when no model is available.
+        # Convert to grayscale once for the whole board
+        if len(board_image.shape) == 3:
+            gray = cv2.cvtColor(board_image, cv2.COLOR_BGR2GRAY)
         else:
-            gray = square_img
-            
-        avg_brightness = np.mean(gray)
+            gray = board_image
         
-        # If brightness is mid-range, assume empty square
-        if 90 < avg_brightness < 170:
-            return ' '
-        
-        # Very bright - assume white piece, darker - assume black
-        if avg_brightness >= 170:
-            # Simplified: return white pawn
-            return 'P'
-        else:
-            # Simplified: return black pawn
-            return 'p'
+        return _classify_squares(gray, square_size)
     
-    def _board_to_fen(self, board):
+    def _classify_pieces(self, board_image, square_size):
         """
-        Convert board array to FEN string
+        Classify all 64 squares with the piece classifier in one batch
         
         Args:
-            board: 8x8 array with piece symbols
+            board_image: Image of the board
+            square_size: Side length of a single square in pixels
             
         Returns:
-            FEN string
+            8x8 uint8 array of piece codes (0 = empty), in image row order
         """
-        fen = ""
-        for row in range(8):
-            empty_count = 0
-            for col in range(8):
-                if board[row][col] == ' ':
-                    empty_count += 1
-                else:
-                    if empty_count > 0:
-                        fen += str(empty_count)
-                        empty_count = 0
-                    fen += board[row][col]
-            if empty_count > 0:
-                fen += str(empty_count)
-            if row < 7:
-                fen += "/"
-                
-        # For simplicity, assume it's white's turn and all castling rights available
-        fen += " w KQkq - 0 1"
+        input_details = self.piece_model.get_input_details()[0]
+        output_details = self.piece_model.get_output_details()[0]
+        channels = input_details['shape'][-1]
+        
+        image = board_image
+        if channels == 3 and len(image.shape) == 2:
+            image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+        elif channels == 1 and len(image.shape) == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        
+        # Scale the board so every square is exactly the model input size,
+        # then split it into a (64, S, S, C) batch in row-major square order
+        size = 8 * square_size
+        n = PIECE_INPUT_SIZE
+        resized = cv2.resize(image[:size, :size], (8 * n, 8 * n),
+                             interpolation=cv2.INTER_AREA)
+        batch = resized.reshape(8, n, 8, n, channels).swapaxes(1, 2).reshape(64, n, n, channels)
+        
+        # Quantize the input if the model expects signed int8
+        if input_details['dtype'] == np.int8:
+            scale, zero_point = input_details['quantization']
+            batch = np.clip(np.round(batch / scale + zero_point), -128, 127).astype(np.int8)
+        else:
+            batch = batch.astype(input_details['dtype'])
+        
+        self.piece_model.set_tensor(input_details['index'], batch)
+        self.piece_model.invoke()
+        logits = self.piece_model.get_tensor(output_details['index'])
         
-        return fen
+        return PIECE_CLASS_CODES[logits.argmax(axis=1)].reshape(8, 8)
@@ -6,6 +6,7 @@ import chess.engine
 import os
 import tempfile
 import time
+from collections import OrderedDict
 from stockfish_engine import StockfishEngine
 
 class ChessAnalyzer:
@@ -13,9 +14,15 @@ class ChessAnalyzer:
     Handles chess position analysis using Stockfish engine
     """
     
-    def __init__(self):
-        """Initialize the chess analyzer"""
-        self.stockfish = StockfishEngine()
+    def __init__(self, hash_mb=None):
+        """
+        Initialize the chess analyzer
+        
+        Args:
+            hash_mb: Size of the Stockfish hash table in MB (default: sized
+                from the available memory)
+        """
+        self.stockfish = StockfishEngine(hash_mb=hash_mb)
         
         # Piece name mapping
         self.piece_names = {
@@ -26,8 +33,17 @@ class ChessAnalyzer:
             chess.QUEEN: "queen",
             chess.KING: "king"
         }
+        
+        # Recent analysis results keyed by (fen, depth, time_limit, want_pv),
+        # so an unchanged board does not trigger another engine search
+        self._cache = OrderedDict()
+        self.cache_size = 128
+        
+        # Last parsed position, reused while moves are formatted for it
+        self._board = None
+        self._board_fen = None
     
-    def analyze_position(self, fen, depth=18, time_limit=2.0):
+    def analyze_position(self, fen, depth=18, time_limit=2.0, want_pv=True):
         """
         Analyze a chess position and return the best move
         
@@ -35,27 +51,64 @@ class ChessAnalyzer:
             fen: The FEN string representing the chess position
             depth: The search depth (default: 18)
             time_limit: Time limit in seconds (default: 2.0)
+            want_pv: Whether to include the principal variation (default: True)
             
         Returns:
             Dict containing best move and evaluation
         """
-        # Create a chess board from the FEN
+        # Reuse the result of a previous search of the same position
+        key = (fen, depth, time_limit, want_pv)
+        cached = self._cache.get(key)
+        if cached is not None:
+            self._cache.move_to_end(key)
+            return dict(cached)
+        
+        # Create a chess board from the FEN. The board is kept, so formatting
+        # the best move afterwards does not parse the FEN again
         try:
-            board = chess.Board(fen)
+            board = self._get_board(fen)
         except ValueError:
             return {"error": "Invalid FEN string"}
         
         # Get the analysis from Stockfish
-        result = self.stockfish.get_best_move(fen, depth, time_limit)
+        result = self.stockfish.get_best_move(board, depth, time_limit, want_pv)
+        
+        # Pass engine errors on rather than report an empty analysis
+        if "error" in result:
+            return {"fen": fen, "error": result["error"]}
         
-        # Return formatted result
-        return {
+        # Format result
+        analysis = {
             "fen": fen,
             "best_move": result.get("best_move"),
             "score": result.get("score"),
             "depth": result.get("depth"),
-            "pv": result.get("pv", [])
+            "pv": result.get("pv", []) if want_pv else None
         }
+        
+        # Only cache searches that were not stopped early by a newer one,
+        # evicting the least recently used
+        if result.get("complete"):
+            self._cache[key] = analysis
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        
+        return dict(analysis)
+    
+    def _get_board(self, fen):
+        """
+        Get a board for a FEN, reusing the last one if the FEN is unchanged
+        
+        Args:
+            fen: The FEN string of the position
+            
+        Returns:
+            chess.Board for the position
+        """
+        if self._board is None or self._board_fen != fen:
+            self._board = chess.Board(fen)
+            self._board_fen = fen
+        return self._board
     
     def format_move_with_pieces(self, fen, move_uci):
         """
@@ -72,15 +125,16 @@ class ChessAnalyzer:
             return "No move available"
         
         try:
-            board = chess.Board(fen)
+            board = self._get_board(fen)
             move = chess.Move.from_uci(move_uci)
+            piece_names = self.piece_names
             
             # Get the piece type
             piece = board.piece_at(move.from_square)
             if not piece:
                 return f"Move from {chess.square_name(move.from_square)} to {chess.square_name(move.to_square)}"
             
-            piece_name = self.piece_names.get(piece.piece_type, "piece")
+            piece_name = piece_names.get(piece.piece_type, "piece")
             color = "white" if piece.color == chess.WHITE else "black"
             
             # Check if the move is a capture
@@ -89,13 +143,13 @@ class ChessAnalyzer:
                 captured_piece = board.piece_at(move.to_square)
                 if captured_piece:
                     captured_color = "white" if captured_piece.color == chess.WHITE else "black"
-                    captured_name = self.piece_names.get(captured_piece.piece_type, "piece")
+                    captured_name = piece_names.get(captured_piece.piece_type, "piece")
                     capture = f", capturing the {captured_color} {captured_name}"
             
             # Check if it's a promotion
             promotion = ""
             if move.promotion:
-                promoted_piece = self.piece_names.get(move.promotion, "piece")
+                promoted_piece = piece_names.get(move.promotion, "piece")
                 promotion = f", promoting to a {promoted_piece}"
             
             # Special cases
@@ -106,14 +160,15 @@ class ChessAnalyzer:
                 else:
                     special_move = " (queenside castling)"
                     
-            # Check if it's a check or checkmate
-            board.push(move)
+            # Check if it's a check or checkmate, leaving the board unchanged
             check_status = ""
-            if board.is_check():
-                if board.is_checkmate():
-                    check_status = ", checkmate"
-                else:
-                    check_status = ", check"
+            if board.gives_check(move):
+                board.push(move)
+                try:
+                    checkmate = board.is_checkmate()
+                finally:
+                    board.pop()
+                check_status = ", checkmate" if checkmate else ", check"
             
             # Format the full move description
             from_square = chess.square_name(move.from_square)
@@ -121,5 +176,5 @@ class ChessAnalyzer:
             
             return f"{color} {piece_name} from {from_square} to {to_square}{capture}{promotion}{special_move}{check_status}"
             
-        except Exception as e:
+        except ValueError:
             return f"Move {move_uci}"
@@ -2,6 +2,7 @@
 Main entry point for the Chess Analyzer Overlay App
 """
 import os
+import logging
 import threading
 from kivy.app import App
 from kivy.core.window import Window
@@ -9,10 +10,12 @@ from kivy.lang import Builder
 from kivy.utils import platform
 from overlay_app import ChessOverlayApp
 
+logger = logging.getLogger(__name__)
+
 # Check if running on Android
 if platform == 'android':
     from android.permissions import request_permissions, Permission
-    from jnius import autoclass
+    from jnius import autoclass, JavaException
 
 def request_android_permissions():
     """Request necessary permissions on Android"""
@@ -43,10 +46,10 @@ def main():
             if not Settings.canDrawOverlays(activity):
                 intent = Intent(Settings.ACTION_MANAGE_OVERLAY_PERMISSION)
                 activity.startActivity(intent)
-                print("Please grant overlay permission and restart the app")
+                logger.warning("Please grant overlay permission and restart the app")
                 return
-        except Exception as e:
-            print(f"Error setting up overlay permissions: {e}")
+        except JavaException as e:
+            logger.error("Error setting up overlay permissions: %s", e)
     
     # Start the app
     app = ChessOverlayApp()
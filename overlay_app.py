@@ -14,14 +14,32 @@ from kivy.utils import platform
 from kivy.properties import ObjectProperty, BooleanProperty
 
 import os
-import threading
+import hashlib
+import logging
 import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
 
 from chess_analyzer import ChessAnalyzer
 from board_detector import ChessBoardDetector
-from stockfish_engine import StockfishEngine
 from tts_service import TTSService
 
+logger = logging.getLogger(__name__)
+
+# Android classes, looked up once
+if platform == 'android':
+    from android.permissions import request_permissions, Permission
+    from jnius import autoclass, JavaException
+    
+    PythonActivity = autoclass('org.kivy.android.PythonActivity')
+    ByteBuffer = autoclass('java.nio.ByteBuffer')
+    Bitmap = autoclass('android.graphics.Bitmap')
+    BitmapConfig = autoclass('android.graphics.Bitmap$Config')
+    Canvas = autoclass('android.graphics.Canvas')
+    LayoutParams = autoclass('android.view.WindowManager$LayoutParams')
+
 class ChessOverlayWidget(FloatLayout):
     """Main widget for the chess overlay app"""
     
@@ -29,11 +47,26 @@ class ChessOverlayWidget(FloatLayout):
         super(ChessOverlayWidget, self).__init__(**kwargs)
         
         # Set up components
+        # A single Stockfish process, owned by the analyzer
         self.analyzer = ChessAnalyzer()
         self.board_detector = ChessBoardDetector()
-        self.stockfish = StockfishEngine()
         self.tts = TTSService()
         
+        # Single long-lived worker thread for analysis runs
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._analysis_future = None
+        
+        # Screenshot buffers, allocated on the first capture
+        self._screen_size = None
+        self._screen_bitmap = None
+        self._screen_canvas = None
+        self._screen_buffer = None
+        self._screenshot_buf = None
+        
+        # Digest of the last analyzed screenshot
+        self._last_hash = None
+        self._status_before_analysis = ""
+        
         # UI elements
         self.layout = BoxLayout(orientation='vertical', 
                                size_hint=(None, None),
@@ -63,7 +96,12 @@ class ChessOverlayWidget(FloatLayout):
         )
         
         # Setup automatic periodic analysis
-        Clock.schedule_interval(lambda dt: self.start_analysis(None), 10)  # Auto-analyze every 10 seconds
+        self._auto_analysis = Clock.schedule_interval(lambda dt: self.start_analysis(None), 10)  # Auto-analyze every 10 seconds
+        
+        # Pause automatic analysis while the screen is off
+        self._screen_receiver = None
+        if platform == 'android':
+            self.setup_screen_receiver()
         
         # Board representation
         self.board_view = BoxLayout(
@@ -81,14 +119,14 @@ class ChessOverlayWidget(FloatLayout):
         # Set up touch events for dragging
         self._touch_offset_x = 0
         self._touch_offset_y = 0
-        self.analyzing = False
         
         # Best move arrow data
         self.best_move_start = None
         self.best_move_end = None
         
-        # Draw best move arrow when available
-        Clock.schedule_interval(self.update_display, 0.5)
+        # Redraw the best move arrow only when it or the board view changes
+        self._redraw_trigger = Clock.create_trigger(self.update_display)
+        self.board_view.bind(pos=self._redraw_trigger, size=self._redraw_trigger)
     
     def on_touch_down(self, touch):
         """Handle touch down event for dragging"""
@@ -106,16 +144,56 @@ class ChessOverlayWidget(FloatLayout):
             return True
         return super(ChessOverlayWidget, self).on_touch_move(touch)
     
+    def setup_screen_receiver(self):
+        """Listen for screen on/off broadcasts on Android"""
+        try:
+            from android.broadcast import BroadcastReceiver
+            
+            self._screen_receiver = BroadcastReceiver(
+                self.on_screen_broadcast, actions=['screen_on', 'screen_off'])
+            self._screen_receiver.start()
+        except (ImportError, JavaException) as e:
+            logger.error("Error registering screen receiver: %s", e)
+            self._screen_receiver = None
+    
+    def on_screen_broadcast(self, context, intent):
+        """Handle screen on/off broadcasts (called from a Java thread)"""
+        screen_on = intent.getAction() == 'android.intent.action.SCREEN_ON'
+        Clock.schedule_once(lambda dt: self.set_auto_analysis(screen_on), 0)
+    
+    def set_auto_analysis(self, enabled):
+        """Resume or pause automatic periodic analysis"""
+        if enabled:
+            # Catch up right away, then continue at the regular interval
+            self._auto_analysis()
+            self.start_analysis(None)
+        else:
+            self._auto_analysis.cancel()
+    
+    def shutdown(self):
+        """Stop automatic analysis and the worker thread without waiting for a search"""
+        self._auto_analysis.cancel()
+        
+        # The worker thread is joined at exit, so stop its search and drop
+        # any queued run instead of letting it finish
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self.analyzer.stockfish.cancel_pending()
+    
     def start_analysis(self, instance):
         """Start chess position analysis"""
-        if self.analyzing:
+        # Skip if the previous analysis is still running
+        if self._analysis_future and not self._analysis_future.done():
             return
         
-        self.analyzing = True
+        # An explicit button press always re-runs the full analysis
+        if instance is not None:
+            self._last_hash = None
+        
+        self._status_before_analysis = self.status_label.text
         self.status_label.text = "Taking screenshot..."
         
-        # Run analysis in a separate thread to avoid blocking UI
-        threading.Thread(target=self.analyze_position, daemon=True).start()
+        # Run analysis on the worker thread to avoid blocking UI
+        self._analysis_future = self._executor.submit(self.analyze_position)
     
     def analyze_position(self):
         """Analyze the chess position from a screenshot"""
@@ -123,6 +201,15 @@ class ChessOverlayWidget(FloatLayout):
             # Take screenshot
             screenshot = self.take_screenshot()
             
+            # Nothing to do if the screen has not changed since the last run
+            screen_hash = self.screenshot_hash(screenshot)
+            if screen_hash == self._last_hash:
+                previous_status = self._status_before_analysis
+                Clock.schedule_once(lambda dt: setattr(self.status_label, 'text',
+                                                      previous_status), 0)
+                return
+            self._last_hash = screen_hash
+            
             # Update status
             Clock.schedule_once(lambda dt: setattr(self.status_label, 'text', 
                                                   "Detecting board..."), 0)
@@ -132,7 +219,6 @@ class ChessOverlayWidget(FloatLayout):
             if board_image is None:
                 Clock.schedule_once(lambda dt: setattr(self.status_label, 'text', 
                                                      "Could not detect chess board"), 0)
-                self.analyzing = False
                 return
             
             # Update status
@@ -144,7 +230,6 @@ class ChessOverlayWidget(FloatLayout):
             if not fen:
                 Clock.schedule_once(lambda dt: setattr(self.status_label, 'text', 
                                                      "Could not recognize position"), 0)
-                self.analyzing = False
                 return
             
             # Update status
@@ -152,7 +237,16 @@ class ChessOverlayWidget(FloatLayout):
                                                   "Analyzing with Stockfish..."), 0)
             
             # Analyze with Stockfish
-            result = self.analyzer.analyze_position(fen)
+            result = self.analyzer.analyze_position(fen, want_pv=False)
+            
+            # Engine failures come back as an error result; show the error
+            # and let the next run retry the same screen
+            if "error" in result:
+                self._last_hash = None
+                error = result["error"]
+                Clock.schedule_once(lambda dt: setattr(self.status_label, 'text',
+                                                     f"Error: {error}"), 0)
+                return
             
             # Get best move information
             best_move = result.get('best_move')
@@ -169,22 +263,50 @@ class ChessOverlayWidget(FloatLayout):
             self.tts.speak(f"Best move: {move_text}")
             
         except Exception as e:
+            # Last resort for the worker thread: report whatever went wrong
+            # and allow the next run to retry the same screen
+            self._last_hash = None
             Clock.schedule_once(lambda dt: setattr(self.status_label, 'text', 
                                                  f"Error: {str(e)}"), 0)
-        finally:
-            self.analyzing = False
+    
+    def screenshot_hash(self, screenshot):
+        """
+        Compute a digest of a downscaled screenshot
+        
+        Args:
+            screenshot: Screenshot image (numpy array)
+            
+        Returns:
+            8-byte digest of a 64x64 grayscale thumbnail, which changes
+            whenever a piece moves on a board-sized part of the screen
+        """
+        if len(screenshot.shape) == 3:
+            gray = cv2.cvtColor(np.ascontiguousarray(screenshot), cv2.COLOR_BGR2GRAY)
+        else:
+            gray = screenshot
+        
+        # Hash the thumbnail exactly; a similarity hash such as dHash often
+        # stays the same when a single piece moves
+        small = cv2.resize(gray, (64, 64), interpolation=cv2.INTER_AREA)
+        return hashlib.blake2b(small.tobytes(), digest_size=8).digest()
     
     def update_analysis_results(self, best_move, move_text, score):
         """Update UI with analysis results"""
         self.status_label.text = f"Best move: {move_text}\nScore: {score}"
         
-        # Store the move coordinates for drawing the arrow
-        self.best_move_start = best_move[:2]  # e.g., "e2"
-        self.best_move_end = best_move[2:4]   # e.g., "e4"
+        # Store the move coordinates for drawing the arrow; there is no move
+        # once the game is over
+        if best_move:
+            self.best_move_start = best_move[:2]  # e.g., "e2"
+            self.best_move_end = best_move[2:4]   # e.g., "e4"
+        else:
+            self.best_move_start = None
+            self.best_move_end = None
+        self._redraw_trigger()
     
     def update_display(self, dt):
         """Update the display with arrows for best moves"""
-        # This method is called periodically to redraw arrows
+        # This method is triggered when the move or board view changes
         if hasattr(self, 'best_move_start') and self.best_move_start:
             # Ensure we have a canvas to draw on
             self.board_view.canvas.clear()
@@ -210,6 +332,9 @@ class ChessOverlayWidget(FloatLayout):
                     x1, y1 = end_x - dx*10 - dy*5, end_y - dy*10 + dx*5
                     x2, y2 = end_x - dx*10 + dy*5, end_y - dy*10 - dx*5
                     Line(points=[end_x, end_y, x1, y1, x2, y2, end_x, end_y], width=2)
+        else:
+            # No move to show, remove the previous arrow
+            self.board_view.canvas.clear()
     
     def algebraic_to_coords(self, algebraic):
         """Convert algebraic chess notation (e.g., 'e4') to screen coordinates"""
@@ -233,44 +358,45 @@ class ChessOverlayWidget(FloatLayout):
         """Take a screenshot of the device screen"""
         if platform == 'android':
             # Android-specific screenshot code
-            from android.permissions import request_permissions, Permission
-            from jnius import autoclass
             
             # Request storage permissions if needed
             request_permissions([Permission.READ_EXTERNAL_STORAGE, 
                                 Permission.WRITE_EXTERNAL_STORAGE])
             
-            # Android classes for screenshot
-            PythonActivity = autoclass('org.kivy.android.PythonActivity')
             activity = PythonActivity.mActivity
             
             # Create a virtual display to get a screenshot
-            View = autoclass('android.view.View')
             activity.getWindow().getDecorView().setDrawingCacheEnabled(True)
             bitmap = activity.getWindow().getDecorView().getDrawingCache()
             
-            # Convert bitmap to a format OpenCV can use
-            ByteBuffer = autoclass('java.nio.ByteBuffer')
-            Bitmap = autoclass('android.graphics.Bitmap')
-            Config = autoclass('android.graphics.Bitmap.Config')
-            
+            # Convert bitmap to a format OpenCV can use. The copy bitmap,
+            # pixel buffer and output array are reused while the screen size
+            # stays the same
             width, height = bitmap.getWidth(), bitmap.getHeight()
-            conf = Config.ARGB_8888
-            bitmap2 = Bitmap.createBitmap(width, height, conf)
-            Canvas = autoclass('android.graphics.Canvas')
-            canvas = Canvas(bitmap2)
-            canvas.drawBitmap(bitmap, 0, 0, None)
+            if self._screen_size != (width, height):
+                conf = BitmapConfig.ARGB_8888
+                self._screen_bitmap = Bitmap.createBitmap(width, height, conf)
+                self._screen_canvas = Canvas(self._screen_bitmap)
+                self._screen_buffer = ByteBuffer.allocate(width * height * 4)
+                self._screenshot_buf = np.empty((height, width, 3), dtype=np.uint8)
+                self._screen_size = (width, height)
+            
+            self._screen_canvas.drawBitmap(bitmap, 0, 0, None)
             
             # Get the pixel data
-            buffer = ByteBuffer.allocate(width * height * 4)
-            bitmap2.copyPixelsToBuffer(buffer)
+            buffer = self._screen_buffer
+            buffer.rewind()
+            self._screen_bitmap.copyPixelsToBuffer(buffer)
             buffer.rewind()
             
-            # Convert to a numpy array for OpenCV
-            import numpy as np
+            # Convert to a numpy array for OpenCV, copying the raw bytes
+            # in one go rather than element by element
             binaryData = buffer.array()
-            np_data = np.array(list(binaryData)).reshape((height, width, 4))
-            screenshot = np_data[:, :, 0:3]  # Remove alpha channel
+            np_data = np.frombuffer(bytes(binaryData), dtype=np.uint8).reshape((height, width, 4))
+            
+            # ARGB_8888 pixels are stored as RGBA bytes; drop alpha and
+            # reorder to the BGR layout OpenCV expects
+            screenshot = cv2.cvtColor(np_data, cv2.COLOR_RGBA2BGR, dst=self._screenshot_buf)
             
             # Clean up
             activity.getWindow().getDecorView().setDrawingCacheEnabled(False)
@@ -279,7 +405,6 @@ class ChessOverlayWidget(FloatLayout):
         else:
             # For non-Android platforms, use a different method
             # This is just a placeholder - would need a different implementation
-            import numpy as np
             
             # Create a dummy screenshot for testing
             return np.zeros((800, 600, 3), dtype=np.uint8)
@@ -300,22 +425,22 @@ class ChessOverlayApp(App):
         
         return ChessOverlayWidget()
     
+    def on_stop(self):
+        """Stop analysis so closing the app does not wait for a search"""
+        if self.root:
+            self.root.shutdown()
+    
     def setup_android_overlay(self):
         """Set up overlay features for Android"""
         try:
-            from jnius import autoclass
-            
-            # Android classes
-            WindowManager = autoclass('android.view.WindowManager$LayoutParams')
-            PythonActivity = autoclass('org.kivy.android.PythonActivity')
             activity = PythonActivity.mActivity
             
             # Set window flags for overlay
             window = activity.getWindow()
-            window.addFlags(WindowManager.FLAG_NOT_FOCUSABLE)
-            window.addFlags(WindowManager.FLAG_LAYOUT_NO_LIMITS)
-            window.addFlags(WindowManager.FLAG_NOT_TOUCH_MODAL)
-            window.addFlags(WindowManager.FLAG_WATCH_OUTSIDE_TOUCH)
+            window.addFlags(LayoutParams.FLAG_NOT_FOCUSABLE)
+            window.addFlags(LayoutParams.FLAG_LAYOUT_NO_LIMITS)
+            window.addFlags(LayoutParams.FLAG_NOT_TOUCH_MODAL)
+            window.addFlags(LayoutParams.FLAG_WATCH_OUTSIDE_TOUCH)
             
-        except Exception as e:
-            print(f"Error setting up Android overlay: {e}")
+        except JavaException as e:
+            logger.error("Error setting up Android overlay: %s", e)
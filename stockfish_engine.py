@@ -2,24 +2,106 @@
 Stockfish engine integration for chess analysis
 """
 import os
+import asyncio
+import concurrent.futures
+import logging
 import subprocess
 import time
 import tempfile
 import threading
+from collections import OrderedDict
 import chess
 import chess.engine
 from kivy.utils import platform
 
+logger = logging.getLogger(__name__)
+
+# Android classes, looked up once
+if platform == 'android':
+    from android.storage import app_storage_path
+    from jnius import autoclass, JavaException
+    
+    PythonActivity = autoclass('org.kivy.android.PythonActivity')
+
+# Fields parsed from the engine's info lines
+ANALYSIS_INFO = chess.engine.INFO_SCORE
+ANALYSIS_INFO_PV = chess.engine.INFO_SCORE | chess.engine.INFO_PV
+
+# Upper bounds for the automatically sized hash table, in MB
+MAX_HASH_MB_MOBILE = 256
+MAX_HASH_MB_DESKTOP = 1024
+DEFAULT_HASH_MB = 32
+
+# Time allowed for starting the engine, and extra time allowed for a
+# search beyond its own time limit, in seconds
+ENGINE_START_TIMEOUT = 10.0
+ENGINE_TIMEOUT_MARGIN = 5.0
+
+# Errors raised when the engine fails to start or stop in time
+ENGINE_ERRORS = (OSError, asyncio.TimeoutError, concurrent.futures.TimeoutError,
+                 chess.engine.EngineError)
+
+# Score strings for the mate distances that come up in practice
+_MATE_STR = {n: f"Mate in {n}" if n > 0 else f"Mated in {-n}"
+             for n in range(-20, 21) if n}
+
+def _available_memory_mb():
+    """Get the available system memory in MB, or None if unknown"""
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) // 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
 class StockfishEngine:
     """
     Integrates with Stockfish 17 chess engine for position analysis
     """
     
-    def __init__(self):
-        """Initialize Stockfish engine"""
+    def __init__(self, hash_mb=None):
+        """
+        Initialize Stockfish engine
+        
+        Args:
+            hash_mb: Size of the hash table in MB (default: a quarter of
+                the available memory, capped per platform)
+        """
+        self.threads = max(1, (os.cpu_count() or 1) - 1)
+        self.hash_mb = hash_mb or self._default_hash_mb()
         self.stockfish_path = self._get_stockfish_path()
         self.engine = None
-        self.engine_lock = threading.Lock()
+        self.engine_pid = None
+        self._transport = None
+        
+        # All engine I/O runs as coroutines on one event loop in a
+        # background thread. The engine protocol queues commands itself, so
+        # callers only wait for their own result and never for a lock
+        self._loop = asyncio.new_event_loop()
+        self._loop_thread = threading.Thread(target=self._loop.run_forever,
+                                             name="stockfish-io", daemon=True)
+        self._loop_thread.start()
+        self._start_lock = asyncio.Lock()
+        
+        # Incremented for every search, so a search can tell whether a newer
+        # one stopped it early
+        self._generation = 0
+        
+        # Throwaway search run once the engine has started
+        self._warmup_future = None
+        
+        # Futures of searches that callers are still waiting for
+        self._pending = set()
+        self._pending_lock = threading.Lock()
+        
+        # Results of recent searches keyed by position
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self.cache_size = 2048
+        
+        # Start the engine once; it is kept running across analyses
         self._init_engine()
     
     def _get_stockfish_path(self):
@@ -27,45 +109,26 @@ class StockfishEngine:
         if platform == 'android':
             # On Android, Stockfish binary should be included in the app
             # and extracted to the app's private storage
-            from android.storage import app_storage_path
-            from jnius import autoclass
-            
             # Get the app's private directory
             app_dir = app_storage_path()
             
             # Get the app's assets
-            PythonActivity = autoclass('org.kivy.android.PythonActivity')
             activity = PythonActivity.mActivity
             assets = activity.getAssets()
             
             # Create the path where we'll extract Stockfish
             stockfish_path = os.path.join(app_dir, 'stockfish')
             
-            # Check if we need to extract the binary
+            # Check if we need to extract the binary. Extraction writes to a
+            # temporary file first, so a binary at this path is always complete
             if not os.path.exists(stockfish_path):
                 try:
-                    # Open the asset (Stockfish 17 binary)
-                    input_stream = assets.open('stockfish')
-                    
-                    # Create the output file
-                    with open(stockfish_path, 'wb') as out_file:
-                        # Read and write in chunks
-                        buff = bytearray(1024)
-                        while True:
-                            length = input_stream.read(buff)
-                            if length <= 0:
-                                break
-                            out_file.write(buff, 0, length)
+                    # Extract the asset (Stockfish 17 binary)
+                    self._extract_asset(assets, 'stockfish', stockfish_path)
                     
-                    # Close the input stream
-                    input_stream.close()
-                    
-                    # Make the extracted file executable
-                    os.chmod(stockfish_path, 0o755)
-                    
-                    print("Stockfish 17 extracted successfully")
-                except Exception as e:
-                    print(f"Error extracting Stockfish: {e}")
+                    logger.info("Stockfish 17 extracted successfully")
+                except (OSError, JavaException) as e:
+                    logger.error("Error extracting Stockfish: %s", e)
                     # Fallback to a default location
                     stockfish_path = '/data/data/org.test.chess_analyzer/files/stockfish'
             
@@ -82,90 +145,380 @@ class StockfishEngine:
                 return 'stockfish'
             return stockfish_path
     
+    def _extract_asset(self, assets, name, path):
+        """
+        Extract an executable from the APK assets
+        
+        Args:
+            assets: Android AssetManager
+            name: Asset name
+            path: Destination path
+        """
+        tmp_path = path + '.tmp'
+        
+        # Uncompressed assets can be opened as a file descriptor into the
+        # APK and copied by the kernel in one go
+        try:
+            asset_fd = assets.openFd(name)
+        except JavaException:
+            asset_fd = None
+        
+        if asset_fd is not None:
+            try:
+                in_fd = asset_fd.getParcelFileDescriptor().getFd()
+                offset = asset_fd.getStartOffset()
+                size = asset_fd.getLength()
+                with open(tmp_path, 'wb') as out_file:
+                    copied = 0
+                    while copied < size:
+                        sent = os.sendfile(out_file.fileno(), in_fd, offset + copied, size - copied)
+                        if sent <= 0:
+                            raise IOError(f"Short copy of asset {name}: {copied} of {size} bytes")
+                        copied += sent
+            finally:
+                asset_fd.close()
+        else:
+            # Compressed asset: stream it in large chunks to keep the number
+            # of calls through JNI low
+            input_stream = assets.open(name)
+            try:
+                with open(tmp_path, 'wb') as out_file:
+                    buff = bytearray(1 << 20)
+                    while True:
+                        length = input_stream.read(buff)
+                        if length <= 0:
+                            break
+                        out_file.write(memoryview(buff)[:length])
+            finally:
+                input_stream.close()
+        
+        # Make the extracted file executable and move it into place
+        os.chmod(tmp_path, 0o755)
+        os.replace(tmp_path, path)
+    
+    def _default_hash_mb(self):
+        """Size the hash table from the available memory"""
+        available = _available_memory_mb()
+        if available is None:
+            return DEFAULT_HASH_MB
+        
+        limit = MAX_HASH_MB_MOBILE if platform == 'android' else MAX_HASH_MB_DESKTOP
+        return max(16, min(limit, available // 4))
+    
+    def _run(self, coro, timeout=None, search=False):
+        """
+        Run a coroutine on the engine event loop and wait for its result
+        
+        Args:
+            coro: Coroutine to run
+            timeout: Time to wait in seconds, or None to wait indefinitely
+            search: Whether the coroutine is a search that cancel_pending()
+                may cancel; starting and stopping the engine never is
+        """
+        future = asyncio.run_coroutine_threadsafe(coro, self._loop)
+        if search:
+            with self._pending_lock:
+                self._pending.add(future)
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise
+        finally:
+            if search:
+                with self._pending_lock:
+                    self._pending.discard(future)
+    
+    def cancel_pending(self):
+        """
+        Cancel all searches that callers are waiting for
+        
+        The running search is stopped in the engine right away and queued
+        ones never start; their callers get an error result
+        """
+        with self._pending_lock:
+            pending = list(self._pending)
+        for future in pending:
+            future.cancel()
+    
+    async def _start_engine(self):
+        """Start and configure the engine process (runs on the event loop)"""
+        # Don't open a console window for the engine on Windows
+        popen_args = {}
+        if platform == 'win':
+            popen_args['creationflags'] = subprocess.CREATE_NO_WINDOW
+        
+        transport, engine = await chess.engine.popen_uci(self.stockfish_path, **popen_args)
+        
+        # Configure Stockfish, leaving one core for the UI
+        try:
+            await engine.configure({
+                "Threads": self.threads,
+                "Hash": self.hash_mb,  # Hash table size in MB
+            })
+        except BaseException:
+            transport.close()
+            raise
+        
+        self._transport = transport
+        self.engine = engine
+        self.engine_pid = transport.get_pid()
+        logger.info("Stockfish started (pid %s)", self.engine_pid)
+    
     def _init_engine(self):
         """Initialize the Stockfish engine"""
         try:
             # Start the engine process
-            with self.engine_lock:
-                self.engine = chess.engine.SimpleEngine.popen_uci(self.stockfish_path)
-                
-                # Configure Stockfish
-                self.engine.configure({
-                    "Threads": 2,  # Use 2 threads for analysis
-                    "Hash": 32,    # Use 32 MB of memory
-                })
-        except Exception as e:
-            print(f"Error initializing Stockfish: {e}")
+            self._run(self._start_engine(), ENGINE_START_TIMEOUT)
+        except ENGINE_ERRORS as e:
+            logger.error("Error initializing Stockfish: %s", e)
             self.engine = None
+            self._transport = None
+            return
+        
+        # Warm the engine up in the background, so app startup isn't blocked
+        self._warmup_future = asyncio.run_coroutine_threadsafe(self._warmup(), self._loop)
     
-    def get_best_move(self, fen, depth=18, time_limit=2.0):
+    async def _warmup(self):
+        """
+        Run a throwaway shallow search (runs on the event loop)
+        
+        The first search pays for loading the network and setting up the
+        engine's tables, so the first analysis the user asks for is slower
+        than the rest unless this has run
+        """
+        try:
+            await self.engine.analyse(chess.Board(), chess.engine.Limit(depth=1),
+                                      info=chess.engine.INFO_NONE)
+        except chess.engine.EngineError:
+            pass
+    
+    def _is_alive(self):
+        """Check whether the engine process is still running"""
+        transport = self._transport
+        return (self.engine is not None and transport is not None
+                and not transport.is_closing() and transport.get_returncode() is None)
+    
+    async def _ensure_alive_async(self):
+        """Restart the engine if it died (runs on the event loop)"""
+        async with self._start_lock:
+            if self._is_alive():
+                return True
+            
+            # Release the dead engine before starting a new one
+            if self._transport is not None:
+                logger.warning("Stockfish (pid %s) stopped, restarting", self.engine_pid)
+                self._transport.close()
+            self.engine = None
+            self._transport = None
+            
+            try:
+                await asyncio.wait_for(self._start_engine(), ENGINE_START_TIMEOUT)
+            except ENGINE_ERRORS as e:
+                logger.error("Error initializing Stockfish: %s", e)
+                self.engine = None
+                self._transport = None
+            return self.engine is not None
+    
+    def _ensure_alive(self):
+        """
+        Make sure the engine is running, restarting it only if it died
+        
+        Returns:
+            True if the engine is available
+        """
+        if self._is_alive():
+            return True
+        return self._run(self._ensure_alive_async())
+    
+    async def _analyse_async(self, board, limit, info_mask):
+        """
+        Search a position (runs on the event loop)
+        
+        Returns:
+            Tuple of the engine info, the best move, and whether the search
+            ran to its limit rather than being stopped by a newer search
+        """
+        # Let the warm-up search finish instead of interrupting it; the
+        # engine is busy setting up until then either way
+        warmup = self._warmup_future
+        if warmup is not None and not warmup.done():
+            await asyncio.shield(asyncio.wrap_future(warmup))
+        
+        self._generation += 1
+        generation = self._generation
+        
+        # MultiPV is managed by python-chess and stays at the engine
+        # default of 1
+        analysis = await self.engine.analysis(board, limit, info=info_mask)
+        
+        # Leaving the block sends "stop" to the engine, including when the
+        # search is cancelled while waiting
+        with analysis:
+            best = await analysis.wait()
+        return analysis.info, best.move, generation == self._generation
+    
+    def _cache_get(self, key, depth, time_limit, want_pv):
+        """
+        Get a cached result at least as deep as a search with these limits
+        
+        A result qualifies if it reached the given depth, or if its search
+        ran out of at least as much time as the given time limit
+        """
+        with self._cache_lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                return None
+            entry_depth, entry_time, result = entry
+            if entry_depth < depth and (entry_time is None or time_limit is None
+                                        or entry_time < time_limit):
+                return None
+            if want_pv and result["pv"] is None:
+                return None
+            self._cache.move_to_end(key)
+        
+        # Cached results are never modified, so copy outside the lock
+        return dict(result)
+    
+    def _cache_put(self, key, depth, time_limit, result):
+        """
+        Store a result, evicting the least recently used one if full
+        
+        Args:
+            key: Cache key of the position
+            depth: Depth the search actually reached
+            time_limit: Time limit the search ran out of, or None if it
+                reached its requested depth
+            result: Result dictionary
+        """
+        with self._cache_lock:
+            # Keep an entry with a PV rather than replace it with one without
+            entry = self._cache.get(key)
+            if (entry is not None and entry[0] >= depth
+                    and result["pv"] is None and entry[2]["pv"] is not None):
+                return
+            self._cache[key] = (depth, time_limit, result)
+            self._cache.move_to_end(key)
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+    
+    def get_best_move(self, fen_or_board, depth=18, time_limit=2.0, want_pv=True):
         """
         Get the best move for a position
         
         Args:
-            fen: FEN string for the position
+            fen_or_board: FEN string or chess.Board for the position
             depth: Maximum search depth
             time_limit: Time limit in seconds
+            want_pv: Whether to include the principal variation; if False
+                the "pv" entry is None and the engine's PVs are not parsed
             
         Returns:
-            Dictionary with best move and evaluation
+            Dictionary with best move and evaluation; "complete" is False
+            when a newer search stopped this one early, so the result should
+            not be kept
         """
-        if not self.engine:
+        # A board that is already parsed is used as is
+        if isinstance(fen_or_board, chess.Board):
+            board = fen_or_board
+        else:
             try:
-                self._init_engine()
-                if not self.engine:
-                    return {"error": "Could not initialize engine"}
-            except Exception as e:
-                return {"error": f"Engine error: {str(e)}"}
+                board = chess.Board(fen_or_board)
+            except ValueError:
+                return {"error": "Invalid FEN string"}
+        
+        # Key results by the EPD, which drops the halfmove and fullmove
+        # clocks and normalizes castling and en passant, so the same
+        # position gets the same key however it was passed in
+        key = board.epd()
+        
+        # Reuse an earlier search of the same position
+        cached = self._cache_get(key, depth, time_limit, want_pv)
+        if cached is not None:
+            return cached
+        
+        # A finished game has no move to search for, so leave the engine
+        # alone instead of spending the whole time limit on it
+        if board.is_game_over(claim_draw=False):
+            return {
+                "best_move": None,
+                "score": "Mate in 0" if board.is_checkmate() else "0.00",
+                "depth": 0,
+                "pv": [] if want_pv else None,
+                "complete": True
+            }
         
+        if not self._ensure_alive():
+            return {"error": "Could not initialize engine"}
+        
+        # Create a time limit
+        limit = chess.engine.Limit(depth=depth, time=time_limit)
+        
+        # Get analysis, only parsing the fields used below
+        info_mask = ANALYSIS_INFO_PV if want_pv else ANALYSIS_INFO
+        timeout = time_limit + ENGINE_TIMEOUT_MARGIN if time_limit else None
         try:
-            # Create a board from the FEN
-            board = chess.Board(fen)
-            
-            # Create a time limit
-            limit = chess.engine.Limit(depth=depth, time=time_limit)
-            
-            # Get analysis
-            with self.engine_lock:
-                info = self.engine.analyse(board, limit)
-                
-                # Extract the principal variation (sequence of best moves)
-                pv = []
-                if 'pv' in info:
-                    for move in info['pv']:
-                        pv.append(move.uci())
-                
-                # Get the best move
-                result = self.engine.play(board, limit)
-                best_move = result.move.uci() if result.move else None
-                
-                # Get the score
-                score = None
-                if 'score' in info:
-                    score_obj = info['score']
-                    if score_obj.is_mate():
-                        # It's a mate score
-                        mate_in = score_obj.mate()
-                        score = f"Mate in {mate_in}" if mate_in > 0 else f"Mated in {-mate_in}"
-                    else:
-                        # It's a centipawn score
-                        cp = score_obj.cp
-                        score = f"{cp/100:.2f}" if cp is not None else "0.00"
-                
-                return {
-                    "best_move": best_move,
-                    "score": score,
-                    "depth": info.get('depth', 0),
-                    "pv": pv
-                }
-                
-        except Exception as e:
-            print(f"Analysis error: {e}")
-            return {"error": f"Analysis error: {str(e)}"}
+            info, move, complete = self._run(
+                self._analyse_async(board, limit, info_mask), timeout, search=True)
+        except concurrent.futures.TimeoutError:
+            return {"error": "Analysis timed out"}
+        except concurrent.futures.CancelledError:
+            return {"error": "Analysis cancelled"}
+        except chess.engine.EngineError as e:
+            logger.warning("Analysis error: %s", e)
+            return {"error": f"Analysis error: {e}"}
+        
+        # The search is done and the engine loop is free again; all
+        # formatting below runs on the caller's thread
+        
+        # Get the best move reported by the engine for this search
+        best_move = move.uci() if move else None
+        
+        # Extract the principal variation (sequence of best moves)
+        pv = None
+        if want_pv:
+            pv = [pv_move.uci() for pv_move in info.get('pv', [])]
+        
+        # Get the score from the side to move's point of view
+        score = None
+        if 'score' in info:
+            score_obj = info['score'].relative
+            if score_obj.is_mate():
+                # It's a mate score
+                mate_in = score_obj.mate()
+                score = _MATE_STR.get(mate_in) or (
+                    f"Mate in {mate_in}" if mate_in > 0 else f"Mated in {-mate_in}")
+            else:
+                # It's a centipawn score
+                cp = score_obj.score()
+                score = f"{cp * 0.01:.2f}" if cp is not None else "0.00"
+        
+        result = {
+            "best_move": best_move,
+            "score": score,
+            "depth": info.get('depth', 0),
+            "pv": pv,
+            "complete": complete
+        }
+        
+        # A search cut short by a newer one is not worth remembering
+        if complete:
+            # Record the depth the search reached, and the time limit if it
+            # ran out before the requested depth was reached
+            reached = result["depth"]
+            self._cache_put(key, reached, time_limit if reached < depth else None, result)
+        return dict(result)
     
     def quit(self):
         """Shut down the engine properly"""
-        if self.engine:
-            with self.engine_lock:
-                self.engine.quit()
-                self.engine = None
+        engine = self.engine
+        if engine:
+            self.cancel_pending()
+            self.engine = None
+            try:
+                self._run(engine.quit(), ENGINE_START_TIMEOUT)
+            except ENGINE_ERRORS as e:
+                logger.warning("Error stopping Stockfish: %s", e)
+            if self._transport is not None:
+                self._loop.call_soon_threadsafe(self._transport.close)
+                self._transport = None
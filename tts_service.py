@@ -2,17 +2,38 @@
 Text-to-speech service for announcing chess moves
 """
 import os
+import logging
+import queue
 import threading
+import time
 from kivy.utils import platform
 
+logger = logging.getLogger(__name__)
+
+# Android classes, looked up once
+if platform == 'android':
+    from jnius import autoclass, JavaException
+    
+    Locale = autoclass('java.util.Locale')
+    TextToSpeech = autoclass('android.speech.tts.TextToSpeech')
+    PythonActivity = autoclass('org.kivy.android.PythonActivity')
+
 class TTSService:
     """
     Text-to-speech service for announcing chess analysis
     """
     
+    # Android TextToSpeech queue mode: add to queue rather than flush queue
+    QUEUE_ADD = 1
+    
     def __init__(self):
         """Initialize the TTS engine based on platform"""
         self.tts_engine = None
+        
+        # Text waiting to be spoken by the pyttsx3 worker thread
+        self._queue = queue.Queue()
+        self._worker = None
+        
         self._init_tts()
     
     def _init_tts(self):
@@ -20,22 +41,20 @@ class TTSService:
         if platform == 'android':
             self._init_android_tts()
         else:
-            self._init_pyttsx3()
+            # pyttsx3 drivers must be used from the thread that created them,
+            # so a single worker thread owns the engine and speaks queued text
+            self._worker = threading.Thread(target=self._run_pyttsx3, daemon=True)
+            self._worker.start()
     
     def _init_android_tts(self):
         """Initialize Android TTS"""
         try:
-            from jnius import autoclass
-            
-            # Get Android TextToSpeech classes
-            Locale = autoclass('java.util.Locale')
-            TextToSpeech = autoclass('android.speech.tts.TextToSpeech')
-            PythonActivity = autoclass('org.kivy.android.PythonActivity')
-            
             # Get the current activity
             activity = PythonActivity.mActivity
             
-            # Initialize TextToSpeech
+            # Initialize TextToSpeech. The listener is not part of stock
+            # python-for-android, so it is only looked up here where a
+            # missing class just disables TTS
             tts_listener = autoclass('org.kivy.android.PythonActivity$TTSListener')
             self.tts_engine = TextToSpeech(activity, tts_listener)
             
@@ -45,9 +64,9 @@ class TTSService:
             # Set speech rate
             self.tts_engine.setSpeechRate(0.9)  # Slightly slower than normal
             
-            print("Android TTS initialized")
-        except Exception as e:
-            print(f"Error initializing Android TTS: {e}")
+            logger.info("Android TTS initialized")
+        except JavaException as e:
+            logger.error("Error initializing Android TTS: %s", e)
             # Fallback to a dummy TTS
             self.tts_engine = None
     
@@ -61,19 +80,50 @@ class TTSService:
             self.tts_engine.setProperty('rate', 160)  # Speed of speech
             self.tts_engine.setProperty('volume', 0.9)  # Volume (0.0 to 1.0)
             
-            # Try to use a better voice if available
+            # Try to use a better voice if available: a female voice in English
+            def is_english_female(voice):
+                name = voice.name.lower()
+                return "english" in name and ("female" in name or "f" in voice.id.lower())
+            
             voices = self.tts_engine.getProperty('voices')
-            for voice in voices:
-                # Try to find a female voice in English
-                if "english" in voice.name.lower() and ("female" in voice.name.lower() or "f" in voice.id.lower()):
-                    self.tts_engine.setProperty('voice', voice.id)
-                    break
+            voice = next((v for v in voices if is_english_female(v)), None)
+            if voice:
+                self.tts_engine.setProperty('voice', voice.id)
             
-            print("pyttsx3 TTS initialized")
+            logger.info("pyttsx3 TTS initialized")
         except Exception as e:
-            print(f"Error initializing pyttsx3: {e}")
+            # Drivers raise their own platform-specific errors
+            logger.error("Error initializing pyttsx3: %s", e)
             self.tts_engine = None
     
+    def _run_pyttsx3(self):
+        """Worker thread that owns the pyttsx3 engine and speaks queued text in order"""
+        self._init_pyttsx3()
+        
+        # Drive the engine with its non-blocking loop instead of runAndWait()
+        if self.tts_engine:
+            try:
+                self.tts_engine.startLoop(False)
+            except RuntimeError as e:
+                logger.error("Error starting pyttsx3 loop: %s", e)
+                self.tts_engine = None
+        
+        while True:
+            text = self._queue.get()
+            if not self.tts_engine:
+                logger.info("TTS not available. Text: %s", text)
+                continue
+            
+            try:
+                self.tts_engine.say(text)
+                while self.tts_engine.isBusy():
+                    self.tts_engine.iterate()
+                    time.sleep(0.01)
+            except Exception:
+                # Keep the worker alive for the next text whatever the
+                # driver raised
+                logger.exception("Error speaking text")
+    
     def speak(self, text):
         """
         Speak the given text using the appropriate TTS engine
@@ -83,34 +133,18 @@ class TTSService:
         """
         if not text:
             return
-            
-        # Speak in a separate thread to avoid blocking the UI
-        threading.Thread(target=self._speak_threaded, args=(text,), daemon=True).start()
-    
-    def _speak_threaded(self, text):
-        """
-        Internal method to speak text in a separate thread
         
-        Args:
-            text: Text to be spoken
-        """
+        if platform != 'android':
+            # Spoken in order by the worker thread to avoid blocking the UI
+            self._queue.put_nowait(text)
+            return
+        
         if not self.tts_engine:
-            print(f"TTS not available. Text: {text}")
+            logger.info("TTS not available. Text: %s", text)
             return
-            
+        
         try:
-            if platform == 'android':
-                # For Android TTS
-                from jnius import autoclass
-                
-                # Constants for TextToSpeech
-                QUEUE_ADD = 1  # Add to queue rather than flush queue
-                
-                # Speak the text
-                self.tts_engine.speak(text, QUEUE_ADD, None)
-            else:
-                # For pyttsx3
-                self.tts_engine.say(text)
-                self.tts_engine.runAndWait()
-        except Exception as e:
-            print(f"Error speaking text: {e}")
+            # Android TTS queues and speaks asynchronously on its own
+            self.tts_engine.speak(text, self.QUEUE_ADD, None)
+        except JavaException as e:
+            logger.warning("Error speaking text: %s", e)